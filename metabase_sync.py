@@ -6,32 +6,80 @@ Handles backup, restore, inspect, and verify operations for Metabase.
 """
 
 import argparse
-import json
+import http.client
 import os
+import re
 import sys
-import urllib.error
-import urllib.request
+import threading
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+
+    _loads, _dumps = orjson.loads, orjson.dumps
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps(obj):
+        # Compact separators, as orjson emits, keep payloads and backups small
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+_ENV_RE = re.compile(r"^[ \t]*([^#=\s][^=\s]*)=(.*?)[ \t\r]*$", re.MULTILINE)
+
+# Zstandard zip entries need Python 3.14+ built with zstd support
+try:
+    import compression.zstd  # noqa: F401
+
+    _HAS_ZSTD = True
+except ImportError:
+    _HAS_ZSTD = False
+
+# Layout fields kept from backed-up dashcards, with fallbacks when absent.
+# Only immutable values here; container fields are built per dashcard.
+_DASHCARD_DEFAULTS = {"row": 0, "col": 0, "size_x": 4, "size_y": 4}
 
 
 # --- UI Helpers ---
+_IS_TTY = sys.stdout.isatty()
+
+
 class UI:
     """Terminal UI helpers."""
 
     G, Y, R, B, BOLD, NC = (
-        "\033[92m",
-        "\033[93m",
-        "\033[91m",
-        "\033[94m",
-        "\033[1m",
-        "\033[0m",
+        (
+            "\033[92m",
+            "\033[93m",
+            "\033[91m",
+            "\033[94m",
+            "\033[1m",
+            "\033[0m",
+        )
+        if _IS_TTY
+        else ("",) * 6
     )
 
     @staticmethod
     def log(symbol, color, msg):
         """Log a formatted message to stdout."""
-        print(f"{color}{symbol} {msg}{UI.NC}")
+        sys.stdout.write(f"{color}{symbol} {msg}{UI.NC}\n")
+        if symbol in ("✗", "⚠"):
+            sys.stdout.flush()
+
+
+# Raised when a reused keep-alive socket was closed before any response arrived
+_STALE_CONN_ERRORS = (
+    http.client.RemoteDisconnected,
+    BrokenPipeError,
+    ConnectionResetError,
+)
 
 
 class MetabaseClient:
@@ -40,25 +88,76 @@ class MetabaseClient:
     def __init__(self, url, user, password):
         self.url, self.user, self.password = url.rstrip("/"), user, password
         self.session_id = None
-
-    def _request(self, method, path, data=None):
-        req = urllib.request.Request(f"{self.url}{path}", method=method)
-        req.add_header("Content-Type", "application/json")
+        parts = urlsplit(self.url)
+        self._conn_cls = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._host, self._prefix = parts.netloc, parts.path
+        self._local = threading.local()
+        self._cache = {}
+        self._pool = ThreadPoolExecutor(max_workers=16)
+
+    def _connection(self):
+        # One kept-alive connection per thread so requests reuse TCP/TLS sessions.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._conn_cls(self._host, timeout=20)
+        return conn
+
+    def _request(self, method, path, data=None, cache=False, parse=True):
+        if cache and method == "GET" and path in self._cache:
+            return self._cache[path]
+        headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
         if self.session_id:
-            req.add_header("X-Metabase-Session", self.session_id)
-        try:
-            body = json.dumps(data).encode("utf-8") if data else None
-            with urllib.request.urlopen(req, data=body, timeout=20) as resp:
+            headers["X-Metabase-Session"] = self.session_id
+        body = _dumps(data) if data else None
+        while True:
+            conn = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, f"{self._prefix}{path}", body, headers)
+                resp = conn.getresponse()
                 raw = resp.read()
-                return json.loads(raw.decode("utf-8")) if raw else {}
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return None
-            UI.log("⚠", UI.Y, f"API Error {e.code} on {path}")
+                break
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                self._local.conn = None
+                # The server may drop idle keep-alive connections before reading
+                # the request; only that case is safe to resend on a fresh one.
+                if not (reused and isinstance(e, _STALE_CONN_ERRORS)):
+                    UI.log("⚠", UI.Y, f"Connection error: {e}")
+                    return None
+        if resp.status == 404:
             return None
-        except (urllib.error.URLError, ValueError) as e:
-            UI.log("⚠", UI.Y, f"Connection error: {e}")
+        if resp.status >= 400:
+            UI.log("⚠", UI.Y, f"API Error {resp.status} on {path}")
             return None
+        if resp.getheader("Content-Encoding") == "gzip":
+            try:
+                raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+            except zlib.error as e:
+                UI.log("⚠", UI.Y, f"Bad response body on {path}: {e}")
+                return None
+        if not parse:
+            # Caller ignores the body; hand back the raw bytes unparsed
+            res = raw
+        else:
+            try:
+                res = _loads(raw) if raw else {}
+            except ValueError as e:
+                UI.log("⚠", UI.Y, f"Bad response body on {path}: {e}")
+                return None
+        if method != "GET":
+            # A write makes cached reads of the path and its parents stale
+            stale = path
+            while stale:
+                self._cache.pop(stale, None)
+                stale = stale.rpartition("/")[0]
+        elif cache:
+            self._cache[path] = res
+        return res
 
     def login(self):
         """Attempt to log in to Metabase."""
@@ -83,73 +182,137 @@ class MetabaseClient:
         return False
 
     def _unwrap(self, res):
-        return (
-            res["data"]
-            if isinstance(res, dict) and "data" in res
-            else (res if isinstance(res, list) else [])
+        # Plain lists (/api/card, /api/dashboard) are the common case
+        if isinstance(res, list):
+            return res
+        if isinstance(res, dict) and "data" in res:
+            return res["data"]
+        if __debug__ and res:
+            UI.log("⚠", UI.Y, f"Unexpected list response: {str(res)[:80]}")
+        return []
+
+    def _dashboard_details(self, dashes):
+        """Fetch full details for each dashboard concurrently, in order."""
+        return list(
+            self._pool.map(
+                lambda d: self._request("GET", f"/api/dashboard/{d['id']}", cache=True),
+                dashes,
+            )
         )
 
     def get_content(self):
         """Retrieve cards and dashboards."""
-        cards = self._unwrap(self._request("GET", "/api/card"))
-        dashes = [
-            self._request("GET", f"/api/dashboard/{d['id']}")
-            for d in self._unwrap(self._request("GET", "/api/dashboard"))
-        ]
+        cards = self._unwrap(self._request("GET", "/api/card", cache=True))
+        dashes = self._dashboard_details(
+            self._unwrap(self._request("GET", "/api/dashboard", cache=True))
+        )
         return cards, [d for d in dashes if d]
 
     def restore_content(self, db_id, cards, dashboards):
         """Restore content from backup."""
-        # 1. Restore Cards (3 passes for dependencies)
+        # 1. Restore Cards (parents before nested cards)
         existing = {
-            c["name"]: c["id"] for c in self._unwrap(self._request("GET", "/api/card"))
-        }
-        id_map = {
-            str(c["id"]): existing[c["name"]] for c in cards if c["name"] in existing
+            c["name"]: c["id"]
+            for c in self._unwrap(self._request("GET", "/api/card", cache=True))
         }
-        to_restore = [c for c in cards if c["name"] not in existing]
-        to_restore.sort(key=lambda x: x.get("id", 0))
-
-        restored = 0
-        for _ in range(3):
-            if not to_restore:
-                break
-            rem = []
-            for c in to_restore:
-                payload = {**c, "collection_id": None}
-                if "id" in payload:
-                    del payload["id"]
-                payload["dataset_query"]["database"] = db_id
-
-                # Update nested dependencies
-                dq = payload["dataset_query"]
-                if dq.get("type") == "query" and "query" in dq:
-                    st = dq["query"].get("source-table")
-                    if isinstance(st, str) and st.startswith("card__"):
-                        old_id = st.replace("card__", "")
-                        if old_id in id_map:
-                            dq["query"]["source-table"] = f"card__{id_map[old_id]}"
-                        else:
-                            rem.append(c)
-                            continue
-
-                res = self._request("POST", "/api/card", payload)
+        id_map = {c["id"]: existing[c["name"]] for c in cards if c["name"] in existing}
+        # Build each payload once; the parent reference is filled in when mapped
+        to_restore = []
+        for c in sorted(cards, key=lambda x: x.get("id", 0)):
+            if c["name"] in existing:
+                continue
+            payload = {**c, "collection_id": None}
+            payload.pop("id", None)
+            dq = payload["dataset_query"] = {**c["dataset_query"], "database": db_id}
+
+            # Note nested dependencies
+            parent = None
+            if dq.get("type") == "query" and "query" in dq:
+                st = dq["query"].get("source-table")
+                if isinstance(st, str) and st.startswith("card__"):
+                    dq["query"] = {**dq["query"]}
+                    # A malformed reference never maps, so the card stays deferred
+                    parent = int(st[6:]) if st[6:].isdecimal() else st
+            to_restore.append((c, payload, parent))
+
+        # Order by dependency: a card is posted once its parent card is mapped,
+        # and a failed card is re-queued with its children still waiting on it
+        level, children = [], {}
+        for item in to_restore:
+            parent = item[2]
+            if parent is None or parent in id_map:
+                level.append(item)
+            else:
+                children.setdefault(parent, []).append(item)
+
+        restored, attempts = 0, {}
+        while level:
+            # Cards on the same level are independent, so post them concurrently
+            for _, payload, parent in level:
+                if parent is not None:
+                    payload["dataset_query"]["query"][
+                        "source-table"
+                    ] = f"card__{id_map[parent]}"
+            results = self._pool.map(
+                lambda item: self._request("POST", "/api/card", item[1]), level
+            )
+            nxt, retry = [], []
+            for item, res in zip(level, results):
+                old_id = item[0]["id"]
                 if res and "id" in res:
-                    id_map[str(c["id"])], restored = res["id"], restored + 1
-                else:
-                    rem.append(c)
-            to_restore = rem
+                    id_map[old_id], restored = res["id"], restored + 1
+                    nxt.extend(children.pop(old_id, []))
+                elif attempts.get(old_id, 1) < 3:
+                    # Give transient failures (5xx, timeouts) up to three tries
+                    attempts[old_id] = attempts.get(old_id, 1) + 1
+                    retry.append(item)
+
+            if retry:
+                # A timed-out POST may still have created the card. Map it only
+                # to an unclaimed card with the same name and query (names are
+                # not unique); when unsure, posting again beats mis-mapping.
+                self._cache.pop("/api/card", None)
+                claimed = set(existing.values()) | set(id_map.values())
+                by_name = {}
+                for sc in self._unwrap(self._request("GET", "/api/card", cache=True)):
+                    if sc["id"] not in claimed:
+                        by_name.setdefault(sc["name"], []).append(sc)
+                for item in retry:
+                    c, payload, _ = item
+                    match = next(
+                        (
+                            sc
+                            for sc in by_name.get(c["name"], [])
+                            if sc["id"] not in claimed
+                            and sc.get("dataset_query") == payload["dataset_query"]
+                        ),
+                        None,
+                    )
+                    if match:
+                        claimed.add(match["id"])
+                        id_map[c["id"]], restored = match["id"], restored + 1
+                        nxt.extend(children.pop(c["id"], []))
+                    else:
+                        nxt.append(item)
+            level = nxt
 
         UI.log(
             "✓",
             UI.G,
-            f"Cards: {restored} restored, {len(cards) - len(to_restore) - restored} existing",
+            f"Cards: {restored} restored, {len(cards) - len(to_restore)} existing",
         )
+        if restored < len(to_restore):
+            UI.log(
+                "⚠",
+                UI.Y,
+                f"Cards: {len(to_restore) - restored} not restored "
+                "(API error or missing parent card)",
+            )
 
         # 2. Restore Dashboards
         dash_map = {
             d["name"]: d["id"]
-            for d in self._unwrap(self._request("GET", "/api/dashboard"))
+            for d in self._unwrap(self._request("GET", "/api/dashboard", cache=True))
         }
         for d in dashboards:
             d_id = dash_map.get(d["name"]) or (
@@ -161,21 +324,19 @@ class MetabaseClient:
             cards_payload = []
             for i, dc in enumerate(d.get("dashcards", d.get("ordered_cards", []))):
                 cid = dc.get("card_id")
-                if cid and str(cid) not in id_map:
+                if cid and cid not in id_map:
                     continue
 
                 # Extract clean card payload for bulk update
-                ndc = {
-                    "id": -(i + 1),
-                    "row": dc.get("row", 0),
-                    "col": dc.get("col", 0),
-                    "size_x": dc.get("size_x", 4),
-                    "size_y": dc.get("size_y", 4),
-                    "visualization_settings": dc.get("visualization_settings", {}),
-                    "parameter_mappings": dc.get("parameter_mappings", []),
-                }
+                ndc = _DASHCARD_DEFAULTS.copy()
+                ndc["id"] = -(i + 1)
+                for k in _DASHCARD_DEFAULTS:
+                    if k in dc:
+                        ndc[k] = dc[k]
+                ndc["visualization_settings"] = dc.get("visualization_settings", {})
+                ndc["parameter_mappings"] = dc.get("parameter_mappings", [])
                 if cid:
-                    ndc["card_id"] = id_map[str(cid)]
+                    ndc["card_id"] = id_map[cid]
                 cards_payload.append(ndc)
 
             UI.log(
@@ -184,34 +345,36 @@ class MetabaseClient:
                 f"Updating dashboard '{d['name']}' ({len(cards_payload)} cards)...",
             )
             self._request(
-                "PUT", f"/api/dashboard/{d_id}/cards", {"cards": cards_payload}
+                "PUT",
+                f"/api/dashboard/{d_id}/cards",
+                {"cards": cards_payload},
+                parse=False,
             )
-        return not to_restore
+        return restored == len(to_restore)
 
     def show_inspect(self):
         """Display current Metabase statistics."""
         props = self._request("GET", "/api/session/properties") or {}
-        cards = self._unwrap(self._request("GET", "/api/card"))
-        dashes = self._unwrap(self._request("GET", "/api/dashboard"))
-        dbs = self._unwrap(self._request("GET", "/api/database"))
+        cards = self._unwrap(self._request("GET", "/api/card", cache=True))
+        dashes = self._unwrap(self._request("GET", "/api/dashboard", cache=True))
+        dbs = self._unwrap(self._request("GET", "/api/database", cache=True))
 
-        print(
-            f"\n{UI.BOLD}--- Metabase Overview ({props.get('version', {}).get('tag')}) ---{UI.NC}"
-        )
-        print(
-            f"Stats: {len(cards)} cards, {len(dashes)} dashboards, {len(dbs)} databases"
-        )
+        lines = [
+            f"\n{UI.BOLD}--- Metabase Overview ({props.get('version', {}).get('tag')}) ---{UI.NC}",
+            f"Stats: {len(cards)} cards, {len(dashes)} dashboards, {len(dbs)} databases",
+        ]
 
         def tree(title, items, fmt=lambda x: x):
             if not items:
                 return
-            print(f"\n{UI.BOLD}{title}{UI.NC}")
+            lines.append(f"\n{UI.BOLD}{title}{UI.NC}")
             for i, item in enumerate(items):
-                print(f"{'└── ' if i == len(items) - 1 else '├── '}{fmt(item)}")
+                lines.append(
+                    f"{'└── ' if i == len(items) - 1 else '├── '}{fmt(item)}"
+                )
 
         dash_details = []
-        for d in dashes:
-            det = self._request("GET", f"/api/dashboard/{d['id']}")
+        for d, det in zip(dashes, self._dashboard_details(dashes)):
             cnt = len(det.get("dashcards", det.get("ordered_cards", []))) if det else 0
             dash_details.append((d["name"], cnt))
 
@@ -221,22 +384,23 @@ class MetabaseClient:
         tree("Databases", dbs, lambda x: x["name"])
         tree(
             "Users",
-            self._unwrap(self._request("GET", "/api/user")),
+            self._unwrap(self._request("GET", "/api/user", cache=True)),
             lambda x: f"{x.get('common_name', x.get('email'))} ({x.get('email')})",
         )
+        sys.stdout.write("\n".join(lines) + "\n")
 
     def verify(self):
         """Check consistency of dashboards and cards."""
         UI.log("→", UI.B, "Verifying Metabase integrity...")
 
         # 1. Check Cards
-        cards = self._unwrap(self._request("GET", "/api/card"))
+        cards = self._unwrap(self._request("GET", "/api/card", cache=True))
         if not cards:
             UI.log("✗", UI.R, "No cards found in Metabase instance.")
             return False
 
         # 2. Check Dashboards
-        dashes = self._unwrap(self._request("GET", "/api/dashboard"))
+        dashes = self._unwrap(self._request("GET", "/api/dashboard", cache=True))
         if not dashes:
             UI.log("✗", UI.R, "No dashboards found in Metabase instance.")
             return False
@@ -247,9 +411,8 @@ class MetabaseClient:
         success = True
         valid_card_ids = {c["id"] for c in cards}
 
-        for d in dashes:
-            # Detailed fetch to get dashcards
-            detailed = self._request("GET", f"/api/dashboard/{d['id']}")
+        # Detailed fetch to get dashcards
+        for d, detailed in zip(dashes, self._dashboard_details(dashes)):
             if not detailed:
                 UI.log("⚠", UI.Y, f"Could not get details for dashboard {d['name']}")
                 success = False
@@ -264,18 +427,16 @@ class MetabaseClient:
                 success = False
                 continue
 
-            missing_cards = []
-            for dc in dash_cards:
-                cid = dc.get("card_id")
-                if cid and cid not in valid_card_ids:
-                    missing_cards.append(cid)
+            missing_cards = {
+                dc.get("card_id") for dc in dash_cards if dc.get("card_id")
+            } - valid_card_ids
 
             if missing_cards:
                 UI.log(
                     "✗",
                     UI.R,
                     f"Dashboard '{d['name']}': Found {len(missing_cards)} missing cards "
-                    f"(IDs: {missing_cards})",
+                    f"(IDs: {sorted(missing_cards)})",
                 )
                 success = False
             else:
@@ -296,15 +457,18 @@ def main():
     """Execute the CLI application."""
     if os.path.exists(".env"):
         with open(".env", encoding="utf-8") as f:
-            for line in f:
-                if "=" in line and not line.startswith("#"):
-                    k, v = line.strip().split("=", 1)
-                    os.environ.setdefault(k, v)
+            for k, v in _ENV_RE.findall(f.read()):
+                os.environ.setdefault(k, v)
 
     p = argparse.ArgumentParser()
     p.add_argument("action", choices=["backup", "restore", "inspect", "verify"])
     p.add_argument("-f", "--file", help="Backup ZIP file")
     p.add_argument("--db", type=int, help="Target DB ID")
+    p.add_argument(
+        "--zstd",
+        action="store_true",
+        help="Compress backup with Zstandard (restore needs Python 3.14+)",
+    )
     args = p.parse_args()
 
     c = MetabaseClient(
@@ -322,13 +486,20 @@ def main():
             args.file
             or f"metabase_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
         )
+        if args.zstd and not _HAS_ZSTD:
+            UI.log("✗", UI.R, "--zstd requires Python 3.14+ with zstd support")
+            return
+        comp, level, label = (
+            (zipfile.ZIP_ZSTANDARD, 3, "zstd")
+            if args.zstd
+            else (zipfile.ZIP_DEFLATED, 1, "deflate")
+        )
         cards, dashes = c.get_content()
-        with zipfile.ZipFile(
-            fname, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
-        ) as zf:
-            zf.writestr("cards.json", json.dumps(cards))
-            zf.writestr("dashboards.json", json.dumps(dashes))
-        UI.log("✓", UI.G, f"Saved to {fname}")
+        with zipfile.ZipFile(fname, "w", compression=comp, compresslevel=level) as zf:
+            for name, obj in (("cards.json", cards), ("dashboards.json", dashes)):
+                with zf.open(name, "w", force_zip64=True) as f:
+                    f.write(_dumps(obj))
+        UI.log("✓", UI.G, f"Saved to {fname} ({label})")
     elif args.action == "restore":
         if not args.file:
             UI.log("✗", UI.R, "File required for restore (-f)")
@@ -341,11 +512,20 @@ def main():
             return
 
         with zipfile.ZipFile(args.file, "r") as zf:
-            c.restore_content(
-                args.db or 1,
-                json.loads(zf.read("cards.json")),
-                json.loads(zf.read("dashboards.json")),
-            )
+            try:
+                with zf.open("cards.json") as f:
+                    cards = _loads(f.read())
+                with zf.open("dashboards.json") as f:
+                    dashes = _loads(f.read())
+            except NotImplementedError:
+                UI.log(
+                    "✗",
+                    UI.R,
+                    "Backup uses zstd compression; "
+                    "restore needs Python 3.14+ with zstd support",
+                )
+                return
+        c.restore_content(args.db or 1, cards, dashes)
     elif args.action == "verify":
         if not c.verify():
             sys.exit(1)